@@ -16,8 +16,7 @@ INSTALL_REQUIRES = [
     'numpy',
     'Pillow',
     'requests',
-    'scikit-image',
-    'scikit-learn>=0.21',
+    'scipy',
     'torch',
     'torchvision',
 ]
@@ -1,6 +1,7 @@
 import math
 import numpy as np
 
+from collections import namedtuple
 from cv2 import resize, INTER_LINEAR
 
 from terran import default_device
@@ -10,6 +11,38 @@ from terran.checkpoint import get_class_for_checkpoint
 TASK_NAME = 'face-detection'
 
 
+class FaceDetections(
+    namedtuple('FaceDetections', ['bboxes', 'landmarks', 'scores'])
+):
+    """Faces detected in a single image, in columnar form.
+
+    This is what face detection models return for each image, so that the
+    detections can be post-processed with vectorized operations instead of
+    one face at a time.
+
+    Attributes
+    ----------
+    bboxes : np.ndarray of size (N, 4)
+        Bounding boxes of the `N` faces, as `[x_min, y_min, x_max, y_max]`.
+    landmarks : np.ndarray of size (N, 5, 2)
+        Landmark coordinates of each face.
+    scores : np.ndarray of size (N,)
+        Confidence score of each face.
+
+    """
+
+    __slots__ = ()
+
+    def as_dicts(self):
+        """Returns the faces as a list of dicts, as `Detection` returns."""
+        return [
+            {'bbox': bbox, 'landmarks': landmarks, 'score': score}
+            for bbox, landmarks, score in zip(
+                self.bboxes, self.landmarks, self.scores
+            )
+        ]
+
+
 def resize_factory(short_side=416):
 
     def resize_in(images):
@@ -64,22 +97,12 @@ def resize_factory(short_side=416):
 
         new_faces_per_image = []
         for faces, scale in zip(faces_per_image, scales):
-
-            new_faces = []
             # TODO: Move rounding to a separate preprocessor. (To also ensure
             # coordinates are valid.)
-            for face in faces:
-                new_faces.append({
-                    'bbox': np.around(
-                        face['bbox'] / scale
-                    ).astype(np.int32),
-                    'landmarks': np.around(
-                        face['landmarks'] / scale
-                    ).astype(np.int32),
-                    'score': face['score'],
-                })
-
-            new_faces_per_image.append(new_faces)
+            new_faces_per_image.append(faces._replace(
+                bboxes=np.around(faces.bboxes / scale).astype(np.int32),
+                landmarks=np.around(faces.landmarks / scale).astype(np.int32),
+            ))
 
         return new_faces_per_image
 
@@ -148,30 +171,14 @@ def merge_factory(method='padding'):
         elif method == 'padding':
             new_faces_per_image = []
             for faces, pads in zip(faces_per_image, params['pads_per_image']):
+                pads_per_axis = np.array(
+                    [pads[1][0], pads[0][0]], dtype=faces.bboxes.dtype
+                )
 
-                new_faces = []
-                for face in faces:
-                    bbox = np.array([
-                        face['bbox'][0] - pads[1][0],
-                        face['bbox'][1] - pads[0][0],
-                        face['bbox'][2] - pads[1][0],
-                        face['bbox'][3] - pads[0][0],
-                    ])
-
-                    pads_per_axis = np.array([
-                        pads[1][0], pads[0][0]
-                    ]).reshape(1, -1)
-                    landmarks = (
-                        face['landmarks'] - pads_per_axis
-                    )
-
-                    new_faces.append({
-                        'bbox': bbox,
-                        'landmarks': landmarks,
-                        'score': face['score'],
-                    })
-
-                new_faces_per_image.append(new_faces)
+                new_faces_per_image.append(faces._replace(
+                    bboxes=faces.bboxes - np.tile(pads_per_axis, 2),
+                    landmarks=faces.landmarks - pads_per_axis,
+                ))
 
             return new_faces_per_image
         else:
@@ -284,6 +291,8 @@ class Detection:
         out = self.merge_out(out, merge_params)
         out = self.resize_out(out, resize_params)
 
+        out = [faces.as_dicts() for faces in out]
+
         return out[0] if expanded else out
 
 
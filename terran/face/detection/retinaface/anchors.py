@@ -64,7 +64,7 @@ def generate_anchor_reference(settings=None, device=default_device):
         anchor = torch.as_tensor(
             generate_anchors(base_size, ratios, scales, stride),
             dtype=torch.float32,
-            device=default_device
+            device=device
         )
 
         anchors.append(anchor)
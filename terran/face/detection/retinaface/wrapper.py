@@ -1,10 +1,11 @@
-import math
+import numpy as np
 import torch
 
-from torchvision.ops import nms
+from torchvision.ops import batched_nms
 
 from terran import default_device
 from terran.checkpoint import get_checkpoint_path
+from terran.face.detection import FaceDetections
 from terran.face.detection.retinaface.anchors import (
     anchors_plane, generate_anchor_reference,
 )
@@ -36,27 +37,18 @@ def decode_bboxes(anchors, deltas):
         Adjusted bounding boxes.
 
     """
-    widths = anchors[:, 2] - anchors[:, 0] + 1.0
-    heights = anchors[:, 3] - anchors[:, 1] + 1.0
-    ctr_x = anchors[:, 0] + 0.5 * (widths - 1.0)
-    ctr_y = anchors[:, 1] + 0.5 * (heights - 1.0)
+    # Work with both coordinates at once, so we launch half as many
+    # operations and allocate half as many temporaries.
+    sizes = anchors[:, 2:] - anchors[:, :2] + 1.0  # (A, 2)
+    ctrs = anchors[:, :2] + 0.5 * (sizes - 1.0)
 
-    dx = deltas[..., 0]  # (N, A)
-    dy = deltas[..., 1]
-    dw = deltas[..., 2]
-    dh = deltas[..., 3]
-
-    pred_ctr_x = dx * widths + ctr_x  # (N, A)
-    pred_ctr_y = dy * heights + ctr_y
-    pred_w = torch.exp(dw) * widths
-    pred_h = torch.exp(dh) * heights
+    pred_ctrs = deltas[..., :2] * sizes + ctrs  # (N, A, 2)
+    pred_half_sizes = 0.5 * (torch.exp(deltas[..., 2:]) * sizes - 1.0)
 
     # Perform the decoding in-place.
     pred = deltas
-    pred[..., 0] = pred_ctr_x - 0.5 * (pred_w - 1.0)
-    pred[..., 1] = pred_ctr_y - 0.5 * (pred_h - 1.0)
-    pred[..., 2] = pred_ctr_x + 0.5 * (pred_w - 1.0)
-    pred[..., 3] = pred_ctr_y + 0.5 * (pred_h - 1.0)
+    pred[..., :2] = pred_ctrs - pred_half_sizes
+    pred[..., 2:] = pred_ctrs + pred_half_sizes
 
     return pred
 
@@ -75,26 +67,153 @@ def decode_landmarks(anchors, deltas):
         Adjusted landmark coordinates.
 
     """
-    widths = anchors[:, 2] - anchors[:, 0] + 1.0
-    heights = anchors[:, 3] - anchors[:, 1] + 1.0
-    ctr_x = anchors[:, 0] + 0.5 * (widths - 1.0)
-    ctr_y = anchors[:, 1] + 0.5 * (heights - 1.0)
+    sizes = anchors[:, 2:] - anchors[:, :2] + 1.0  # (A, 2)
+    ctrs = anchors[:, :2] + 0.5 * (sizes - 1.0)
 
-    # Perform the decoding in-place.
+    # Perform the decoding in-place, for all five landmarks at once.
     pred = deltas
-    for i in range(5):
-        pred[..., i, 0] = deltas[..., i, 0] * widths + ctr_x
-        pred[..., i, 1] = deltas[..., i, 1] * heights + ctr_y
+    pred.mul_(sizes[:, None, :]).add_(ctrs[:, None, :])
 
     return pred
 
 
+def fast_nms(boxes, iou_threshold, max_pairs=2 ** 22):
+    """Performs Fast NMS over `boxes`, which must be sorted by score.
+
+    Instead of greedily suppressing boxes one at a time, computes the full
+    pairwise IoU matrix and keeps the boxes that don't overlap above
+    `iou_threshold` with any higher-scoring box. It's slightly more aggressive
+    than greedy NMS, as already-suppressed boxes may still suppress others,
+    but runs as a handful of batched operations.
+
+    Parameters
+    ----------
+    boxes : torch.Tensor of shape (N, M, 4)
+        Boxes for each of the `N` images, sorted by decreasing score. Boxes
+        only suppress boxes of the same image.
+    iou_threshold : float
+        Boxes overlapping a higher-scoring one above this value are discarded.
+    max_pairs : int
+        Maximum number of box pairs to compute the IoU for at once. Images are
+        processed in chunks as large as this allows (but at least one image
+        at a time), which bounds the memory used by large batches.
+
+    Returns
+    -------
+    torch.Tensor of shape (N, M)
+        Mask indicating which boxes to keep.
+
+    """
+    N, M = boxes.shape[:2]
+    images_per_chunk = max(1, max_pairs // (M * M))
+
+    keep = torch.empty((N, M), dtype=torch.bool, device=boxes.device)
+    for start in range(0, N, images_per_chunk):
+        chunk = boxes[start:start + images_per_chunk]
+        x_min, y_min, x_max, y_max = chunk.unbind(dim=-1)  # (n, M)
+        areas = (x_max - x_min) * (y_max - y_min)
+
+        # Intersection sides between every pair of boxes, (n, M, M). Done one
+        # side at a time and in-place, to keep as few temporaries as possible.
+        intersection = torch.min(
+            x_max[:, :, None], x_max[:, None, :]
+        ).sub_(torch.max(x_min[:, :, None], x_min[:, None, :])).clamp_(min=0)
+        intersection.mul_(torch.min(
+            y_max[:, :, None], y_max[:, None, :]
+        ).sub_(torch.max(y_min[:, :, None], y_min[:, None, :])).clamp_(min=0))
+
+        union = (areas[:, :, None] + areas[:, None, :]).sub_(intersection)
+        iou = intersection.div_(union)
+        del union
+
+        # Only keep the IoU values against higher-scoring boxes, i.e. those
+        # above the diagonal.
+        max_iou, _ = iou.triu_(diagonal=1).max(dim=1)
+        keep[start:start + images_per_chunk] = max_iou < iou_threshold
+
+    return keep
+
+
+def greedy_nms(boxes, scores, iou_threshold, mask=None):
+    """Performs greedy NMS over `boxes`.
+
+    Has the same interface as :func:`fast_nms` but uses `torchvision`'s
+    compiled implementation, which is exact and, on CPUs, where there's little
+    to gain from computing the full IoU matrices at once, considerably faster.
+
+    Parameters
+    ----------
+    boxes : torch.Tensor of shape (N, M, 4)
+        Boxes for each of the `N` images. Boxes only suppress boxes of the
+        same image.
+    scores : torch.Tensor of shape (N, M)
+        Scores for each of the boxes.
+    iou_threshold : float
+        Boxes overlapping a higher-scoring one above this value are discarded.
+    mask : torch.Tensor of shape (N, M), optional
+        If present, only the boxes within the mask are considered (and thus
+        may be kept).
+
+    Returns
+    -------
+    torch.Tensor of shape (N, M)
+        Mask indicating which boxes to keep.
+
+    """
+    if mask is None:
+        mask = torch.ones_like(scores, dtype=torch.bool)
+
+    # Flatten the boxes of every image into a single set, along with the
+    # index of the image each belongs to, so NMS is done in a single call.
+    image_idxs, box_idxs = torch.where(mask)
+    kept = batched_nms(
+        boxes[image_idxs, box_idxs], scores[image_idxs, box_idxs],
+        image_idxs, iou_threshold
+    )
+
+    keep = torch.zeros_like(mask)
+    keep[image_idxs[kept], box_idxs[kept]] = True
+
+    return keep
+
+
 class RetinaFace:
 
-    def __init__(self, device=default_device, nms_threshold=0.4):
+    def __init__(
+        self, device=default_device, nms_threshold=0.4, pre_nms_top_k=2000,
+        nms_method=None, half_precision=False
+    ):
         self.device = device
         self.nms_threshold = nms_threshold
 
+        # NMS algorithm to use, either `greedy` (exact, through torchvision)
+        # or `fast` (Fast NMS, see :func:`fast_nms`). Fast NMS only pays off
+        # on GPUs, where it's the default, but it's slightly more aggressive,
+        # so results may differ from those obtained on CPUs. Pass `greedy`
+        # explicitly to get the same detections on every device.
+        if nms_method is None:
+            nms_method = (
+                'fast' if torch.device(self.device).type == 'cuda'
+                else 'greedy'
+            )
+        if nms_method not in ('fast', 'greedy'):
+            raise ValueError(
+                "`nms_method` must be either 'fast' or 'greedy'."
+            )
+        self.nms_method = nms_method
+
+        # Maximum number of proposals per image to run NMS over. Only the
+        # highest-scoring ones are kept, which bounds the cost of NMS on
+        # crowded images.
+        self.pre_nms_top_k = pre_nms_top_k
+
+        # Whether to run the network itself in FP16. Only makes sense on GPUs,
+        # where convolutions may run on tensor cores. The outputs are cast
+        # back to FP32 before decoding, so predictions are decoded as usual.
+        if half_precision and torch.device(self.device).type != 'cuda':
+            raise ValueError('`half_precision` is only supported on GPUs.')
+        self.half_precision = half_precision
+
         # Anchor settings and feature strides used, specific to the `mnet`
         # backbone.
         self.feature_strides = [32, 16, 8]
@@ -128,7 +247,39 @@ class RetinaFace:
             for stride, anchors in self.anchor_references.items()
         }
 
+        # Anchor planes only depend on the feature map dimensions, so they're
+        # cached by `(height, width, stride)` across calls. Must be treated as
+        # read-only.
+        self._anchors_cache = {}
+
+        # Page-locked host and device buffers used to move the input batches
+        # to the GPU, reused across calls with the same input shape.
+        self._input_buffers = {}
+
         self.model = load_model().to(self.device)
+        if self.half_precision:
+            self.model.half()
+
+    def _upload(self, data):
+        """Moves `data` to the GPU through the reusable staging buffers."""
+        key = (data.shape, data.dtype)
+        if key not in self._input_buffers:
+            # Only keep the buffers for the last input shape, so varying input
+            # sizes don't pile up page-locked memory.
+            self._input_buffers = {
+                key: (
+                    torch.empty(
+                        data.shape, dtype=data.dtype, pin_memory=True
+                    ),
+                    torch.empty(
+                        data.shape, dtype=data.dtype, device=self.device
+                    ),
+                )
+            }
+
+        host_buffer, device_buffer = self._input_buffers[key]
+        host_buffer.copy_(data)
+        return device_buffer.copy_(host_buffer, non_blocking=True)
 
     def call(self, images, threshold=0.5):
         """Run the detection.
@@ -137,102 +288,154 @@ class RetinaFace:
 
         (Padding must be performed outside.)
         """
-        H, W = images.shape[1:3]
-
-        # Load the batch in to a `torch.Tensor` and pre-process by turning it
-        # into a BGR format for the channels.
-        data = torch.as_tensor(
-            images, device=self.device, dtype=torch.float32
-        ).permute(0, 3, 1, 2).flip(1)
+        N = images.shape[0]
+
+        # Load the batch in to a `torch.Tensor` and move it to the device as is
+        # (i.e. usually as `uint8`) from page-locked memory, so the transfer is
+        # as small and fast as possible. Once there, pre-process it by turning
+        # it into a BGR format for the channels, casting to float and making
+        # it channels-first in a single pass.
+        data = torch.from_numpy(np.ascontiguousarray(images))
+        if torch.device(self.device).type == 'cuda':
+            data = self._upload(data)
+        data = data.flip(3).permute(0, 3, 1, 2).to(
+            torch.float16 if self.half_precision else torch.float32,
+            memory_format=torch.contiguous_format
+        )
 
         # Run the images through the network. Disable gradients, as they're not
         # needed.
         with torch.no_grad():
             output = self.model(data)
 
-        # Calculate the base anchor coordinates per stride of the FPN.
-        anchors_per_stride = {}
-        for stride in self.feature_strides:
-            # Input dimensions after model downsampling (i.e. feature map
-            # dimensions).
-            height = math.ceil(H / stride)
-            width = math.ceil(W / stride)
-
-            anchor_ref = self.anchor_references[stride]
-            anchors = anchors_plane(anchor_ref, height, width, stride)
-            anchors_per_stride[stride] = anchors
-
-        # Decode the outputs of the model, adjusting the anchors.
-        proposals_list = []
-        scores_list = []
-        landmarks_list = []
+        if self.half_precision:
+            output = [out.float() for out in output]
+
+        # Decode the outputs of the model, adjusting the anchors. The outputs
+        # of every stride are written directly into preallocated buffers for
+        # the whole batch, so there's no need to concatenate them afterwards.
+        num_anchors = sum(
+            output[stride_idx * 3].shape[2] * output[stride_idx * 3].shape[3]
+            * self.num_anchors_per_stride[stride]
+            for stride_idx, stride in enumerate(self.feature_strides)
+        )
+        batch_scores = output[0].new_empty((N, num_anchors))
+        batch_proposals = output[0].new_empty((N, num_anchors, 4))
+        batch_landmarks = output[0].new_empty((N, num_anchors, 5, 2))
+
+        offset = 0
         for stride_idx, stride in enumerate(self.feature_strides):
             # Three per stride: class, bbox, landmark.
             idx = stride_idx * 3
 
-            anchors = anchors_per_stride[stride]
+            # Input dimensions after model downsampling (i.e. feature map
+            # dimensions), as actually returned by the network.
+            height, width = output[idx].shape[2:]
+
+            # Calculate the base anchor coordinates for the stride.
+            key = (height, width, stride)
+            if key not in self._anchors_cache:
+                self._anchors_cache[key] = anchors_plane(
+                    self.anchor_references[stride], height, width, stride
+                )
+            anchors = self._anchors_cache[key]
+
             A = self.num_anchors_per_stride[stride]
-            N = output[idx].shape[0]
+            stride_slice = slice(offset, offset + anchors.shape[0])
+            offset += anchors.shape[0]
+
+            # Copy the outputs into the stride's section of the buffers, with
+            # the same (height, width, anchor) ordering as `anchors`.
+            scores = batch_scores[:, stride_slice]
+            scores.view(N, height, width, A).copy_(
+                output[idx][:, A:, :, :].permute(0, 2, 3, 1)
+            )
 
-            scores = output[idx]
-            scores = scores[:, A:, :, :]
-            scores = scores.permute(0, 2, 3, 1).reshape(N, -1)
+            proposals = batch_proposals[:, stride_slice]
+            proposals.view(N, height, width, A, 4).copy_(
+                output[idx + 1].view(N, A, 4, height, width).permute(
+                    0, 3, 4, 1, 2
+                )
+            )
 
-            bbox_deltas = output[idx + 1]
-            bbox_pred_len = bbox_deltas.shape[1] // A
-            bbox_deltas = bbox_deltas.permute(0, 2, 3, 1).reshape(
-                (N, -1, bbox_pred_len)
+            landmarks = batch_landmarks[:, stride_slice]
+            landmarks.view(N, height, width, A, 5, 2).copy_(
+                output[idx + 2].view(N, A, 5, 2, height, width).permute(
+                    0, 4, 5, 1, 2, 3
+                )
             )
 
-            landmark_deltas = output[idx + 2]
-            landmark_pred_len = landmark_deltas.shape[1] // A
-            landmark_deltas = landmark_deltas.permute(0, 2, 3, 1).reshape(
-                (N, -1, 5, landmark_pred_len // 5)
+            decode_bboxes(anchors, proposals)
+            decode_landmarks(anchors, landmarks)
+
+        # Select the top-scoring proposals of each image, sorted by score. We
+        # only need as many as the image with most proposals above
+        # `threshold` has, up to `pre_nms_top_k`.
+        num_proposals = int((batch_scores >= threshold).sum(dim=1).max())
+        if num_proposals == 0:
+            return [
+                FaceDetections(
+                    bboxes=np.empty((0, 4), dtype=np.float32),
+                    landmarks=np.empty((0, 5, 2), dtype=np.float32),
+                    scores=np.empty((0,), dtype=np.float32),
+                )
+                for _ in range(N)
+            ]
+
+        scores, anchor_idxs = batch_scores.topk(
+            min(num_proposals, self.pre_nms_top_k), dim=1
+        )
+
+        image_range = torch.arange(N, device=anchor_idxs.device)[:, None]
+        proposals = batch_proposals[image_range, anchor_idxs]
+        landmarks = batch_landmarks[image_range, anchor_idxs]
+
+        # Run the predictions through non-maximum suppression, for every image
+        # in a single pass, and discard the proposals below `threshold` that
+        # images with fewer proposals got padded with. As these are sorted
+        # last, they can't suppress any of the others. Greedy NMS can skip the
+        # padding altogether.
+        valid = scores >= threshold
+        if self.nms_method == 'fast':
+            keep = fast_nms(proposals, self.nms_threshold) & valid
+        else:
+            keep = greedy_nms(
+                proposals, scores, self.nms_threshold, mask=valid
             )
 
-            proposals = decode_bboxes(anchors, bbox_deltas)
-            landmarks = decode_landmarks(anchors, landmark_deltas)
-
-            scores_list.append(scores)
-            proposals_list.append(proposals)
-            landmarks_list.append(landmarks)
-
-        batch_scores = torch.cat(scores_list, dim=1)
-        batch_proposals = torch.cat(proposals_list, dim=1)
-        batch_landmarks = torch.cat(landmarks_list, dim=1)
-
-        # Collect the predictions per image, filtering low-scoring proposals
-        # and performing NMS.
-        batch_objects = []
-        for image_idx in range(images.shape[0]):
-            scores = batch_scores[image_idx]
-            proposals = batch_proposals[image_idx]
-            landmarks = batch_landmarks[image_idx]
-
-            order = torch.where(scores >= threshold)[0]
-            proposals = proposals[order, :]
-            scores = scores[order]
-            landmarks = landmarks[order, :]
-
-            if proposals.shape[0] == 0:
-                batch_objects.append([])
-                continue
-
-            # Re-order all proposals according to score.
-            order = scores.argsort(descending=True)
-            proposals = proposals[order]
-            scores = scores[order]
-            landmarks = landmarks[order]
-
-            # Run the predictions through non-maximum suppression.
-            keep = nms(proposals, scores, self.nms_threshold)
-            proposals = proposals[keep].to('cpu').numpy()
-            scores = scores[keep].to('cpu').numpy()
-            landmarks = landmarks[keep].to('cpu').numpy()
-
-            batch_objects.append([
-                {'bbox': b, 'landmarks': l, 'score': s}
-                for s, b, l in zip(scores, proposals, landmarks)
-            ])
-
-        return batch_objects
+        # Indices are returned in row-major order, that is, by image and then
+        # by decreasing score.
+        image_idxs, proposal_idxs = torch.where(keep)
+        scores = scores[image_idxs, proposal_idxs]
+        proposals = proposals[image_idxs, proposal_idxs]
+        landmarks = landmarks[image_idxs, proposal_idxs]
+
+        # Move the kept predictions over to the CPU with a single transfer,
+        # unpacking them afterwards.
+        kept = torch.cat([
+            image_idxs[:, None].to(scores.dtype),
+            scores[:, None],
+            proposals,
+            landmarks.reshape(-1, 10),
+        ], dim=1).to('cpu').numpy()
+
+        image_idxs = kept[:, 0].astype(np.int64)
+        scores = kept[:, 1]
+        proposals = kept[:, 2:6]
+        landmarks = kept[:, 6:].reshape(-1, 5, 2)
+
+        # Collect the predictions per image.
+        splits = np.cumsum(np.bincount(image_idxs, minlength=N))[:-1]
+
+        return [
+            FaceDetections(
+                bboxes=image_proposals,
+                landmarks=image_landmarks,
+                scores=image_scores,
+            )
+            for image_proposals, image_landmarks, image_scores in zip(
+                np.split(proposals, splits),
+                np.split(landmarks, splits),
+                np.split(scores, splits),
+            )
+        ]
@@ -1,9 +1,10 @@
 import numpy as np
 import torch
+import torch.nn.functional as F
 
+from concurrent.futures import ThreadPoolExecutor
+from cv2 import warpAffine, INTER_LINEAR, BORDER_CONSTANT
 from PIL import Image
-from sklearn.preprocessing import normalize
-from skimage.transform import SimilarityTransform
 
 from terran import default_device
 from terran.checkpoint import get_checkpoint_path
@@ -19,21 +20,91 @@ def load_model():
     return model
 
 
-def preprocess_face(image, landmark, image_size=(112, 112)):
-    """Prepares the face image for the recognition model.
+def estimate_similarity_batch(dst, src):
+    """Estimates the similarity transforms that map each of `dst` onto `src`.
+
+    Vectorized version of Umeyama's closed-form least-squares estimation (as
+    done by `skimage.transform.SimilarityTransform`), solving for every set of
+    points at once instead of one at a time.
+
+    Parameters
+    ----------
+    dst : np.ndarray of size (N, P, 2)
+        Coordinates of the `P` points for each of the `N` sets to transform.
+    src : np.ndarray of size (P, 2)
+        Target coordinates of the `P` points.
+
+    Returns
+    -------
+    np.ndarray of size (N, 2, 3)
+        Affine matrices of each of the transformations.
+
+    """
+    num_points = dst.shape[1]
+
+    dst_mean = dst.mean(axis=1)  # (N, 2)
+    src_mean = src.mean(axis=0)  # (2,)
+    dst_demean = dst - dst_mean[:, None, :]
+    src_demean = src - src_mean
+
+    # Covariance between target and source points, as `src.T @ dst`.
+    cov = np.einsum('pi,npj->nij', src_demean, dst_demean) / num_points
+
+    # Flip the sign of the last singular value for reflections, so we always
+    # return proper rotations.
+    d = np.ones((dst.shape[0], 2), dtype=cov.dtype)
+    d[np.linalg.det(cov) < 0, 1] = -1
+
+    U, S, V = np.linalg.svd(cov)
+    rotation = U @ (d[:, :, None] * V)
+
+    scale = (S * d).sum(axis=1) / dst_demean.var(axis=1).sum(axis=1)
+
+    transforms = np.empty((dst.shape[0], 2, 3), dtype=cov.dtype)
+    transforms[:, :, :2] = scale[:, None, None] * rotation
+    transforms[:, :, 2] = src_mean - np.einsum(
+        'nij,nj->ni', transforms[:, :, :2], dst_mean
+    )
+
+    return transforms
+
+
+def preprocess_faces(image, landmarks, image_size=(112, 112), executor=None):
+    """Prepares all the faces within an image for the recognition model.
 
     Uses the detected landmarks from the face detection stage, then aligns
-    the image, pads to `image_side`x`image_side`, and turns it into the BGR
-    CxHxW format.
+    each face and pads it to `image_side`x`image_side`. Faces are kept as
+    RGB, HxWxC images, so they're written with contiguous copies: turning
+    them into the BGR CxHxW format the model expects is left to the device.
 
     Parameters
     ----------
-    image : np.ndarray of size HxWxC.
-        Image containing a face to preprocess.
-    landmark : np.ndarray of size (5, 2).
-        Landmark coordinates.
+    image : np.ndarray of size HxWx3 and dtype `uint8`.
+        Image containing the faces to preprocess.
+    landmarks : np.ndarray of size (N, 5, 2).
+        Landmark coordinates for each of the `N` faces.
+    executor : concurrent.futures.Executor, optional
+        If present, faces are aligned in parallel through the executor.
+
+    Returns
+    -------
+    np.ndarray of size (N, image_size[0], image_size[1], 3)
+        Aligned faces.
+
+    Raises
+    ------
+    ValueError
+        If `image` isn't an RGB, `uint8` image.
 
     """
+    # The faces are warped in place into the output buffer, which OpenCV can
+    # only do if it matches the image's format, so make sure it does.
+    image = np.ascontiguousarray(image)
+    if image.ndim != 3 or image.shape[2] != 3 or image.dtype != np.uint8:
+        raise ValueError(
+            f'`image` must be an RGB image of shape (H, W, 3) and dtype '
+            f'`uint8`, but got shape {image.shape} and dtype {image.dtype}.'
+        )
 
     # Target location of the facial landmarks.
     src = np.array([
@@ -47,35 +118,67 @@ def preprocess_face(image, landmark, image_size=(112, 112)):
     if image_size[1] == 112:
         src[:, 0] += 8.0
 
-    dst = landmark.astype(np.float32)
-
-    t_form = SimilarityTransform()
-    t_form.estimate(dst, src)
-
-    #
-    # Do align using landmark.
-    #
-    # The Image.transform method requires the inverted transformation matrix,
-    # without the last row, and flattened
-    #
-    t_matrix = np.linalg.inv(t_form.params)[0: -1, :].flatten()
-
-    warped = Image.fromarray(image).transform(
-        size=(image_size[1], image_size[0]),
-        method=Image.AFFINE,
-        data=t_matrix,
-        resample=Image.BILINEAR,
-        fillcolor=0,
+    # Estimate in double precision, as the matrices are small and the warp is
+    # sensitive to rounding errors.
+    t_matrices = estimate_similarity_batch(
+        np.asarray(landmarks, dtype=np.float64), src.astype(np.float64)
     )
 
-    warped = np.array(warped)
-    return warped.transpose([2, 0, 1])[::-1, ...]
+    preprocessed = np.empty(
+        (len(t_matrices), image_size[0], image_size[1], image.shape[2]),
+        dtype=image.dtype
+    )
 
+    def align(idx):
+        # Do align using landmarks, writing the result in place.
+        warped = warpAffine(
+            src=image,
+            M=t_matrices[idx],
+            dsize=(image_size[1], image_size[0]),
+            dst=preprocessed[idx],
+            flags=INTER_LINEAR,
+            borderMode=BORDER_CONSTANT,
+            borderValue=0,
+        )
+        assert np.shares_memory(warped, preprocessed[idx]), (
+            'Face was not aligned in place.'
+        )
 
-def preprocess_face_no_landmarks(image, image_side=112):
-    """Preprocess a face without landmarks.
+    # OpenCV releases the GIL while warping, so aligning through a thread
+    # pool does run in parallel.
+    if executor is not None:
+        list(executor.map(align, range(len(t_matrices))))
+    else:
+        for idx in range(len(t_matrices)):
+            align(idx)
+
+    return preprocessed
 
-    Resize image to have side `image_side` and add padding around it.
+
+def preprocess_face(image, landmark, image_size=(112, 112)):
+    """Prepares the face image for the recognition model.
+
+    Single-face version of :func:`preprocess_faces`, that also turns the
+    face into the BGR CxHxW format.
+
+    Parameters
+    ----------
+    image : np.ndarray of size HxWxC.
+        Image containing a face to preprocess.
+    landmark : np.ndarray of size (5, 2).
+        Landmark coordinates.
+
+    """
+    return preprocess_faces(
+        image, np.expand_dims(landmark, 0), image_size=image_size
+    )[0].transpose([2, 0, 1])[::-1, ...]
+
+
+def _preprocess_face_no_landmarks(image, image_side=112):
+    """Resizes the face to have side `image_side` and pads it.
+
+    As with :func:`preprocess_faces`, the face is kept as an RGB, HxWxC
+    image, which is what :meth:`ArcFace.call` expects.
     """
     face = Image.fromarray(image)
 
@@ -90,22 +193,43 @@ def preprocess_face_no_landmarks(image, image_side=112):
     y_max = int((image_side - face.size[1]) / 2) + face.size[1]
 
     preprocessed = np.zeros(
-        (3, image_side, image_side), dtype=np.uint8
-    )
-    preprocessed[:, y_min:y_max, x_min:x_max] = (
-        np.asarray(face).transpose([2, 0, 1])[::-1, ...]
+        (image_side, image_side, 3), dtype=np.uint8
     )
+    preprocessed[y_min:y_max, x_min:x_max] = np.asarray(face)
 
     return preprocessed
 
 
+def preprocess_face_no_landmarks(image, image_side=112):
+    """Preprocess a face without landmarks.
+
+    Resize image to have side `image_side` and add padding around it. The
+    face is returned in the BGR CxHxW format, as with :func:`preprocess_face`.
+    """
+    return _preprocess_face_no_landmarks(
+        image, image_side=image_side
+    ).transpose([2, 0, 1])[::-1, ...]
+
+
 class ArcFace:
 
-    def __init__(self, device=default_device, image_side=112):
+    def __init__(
+        self, device=default_device, image_side=112, batch_size=64,
+        num_workers=4
+    ):
         self.device = device
         self.model = load_model().to(self.device)
         self.image_side = image_side
 
+        # Maximum number of faces to feed through the network at once.
+        self.batch_size = batch_size
+
+        # Threads used to align the faces of an image in parallel.
+        self.executor = (
+            ThreadPoolExecutor(max_workers=num_workers)
+            if num_workers > 1 else None
+        )
+
     def call(self, images, faces_per_image=None):
         """Performs feature extraction on `images`.
 
@@ -137,10 +261,13 @@ class ArcFace:
         preprocessed = []
         if faces_per_image is not None:
             for image, faces in zip(images, faces_per_image):
-                for face in faces:
-                    preprocessed.append(
-                        preprocess_face(image, face['landmarks'])
-                    )
+                if not faces:
+                    continue
+
+                preprocessed.extend(preprocess_faces(
+                    image, np.stack([face['landmarks'] for face in faces]),
+                    executor=self.executor
+                ))
 
             # A bit of magic, but gets us the index within `preprocessed` where
             # faces of each image start.
@@ -149,7 +276,7 @@ class ArcFace:
             # No landmarks provided, so preprocess it manually.
             for image in images:
                 preprocessed.append(
-                    preprocess_face_no_landmarks(image, self.image_side)
+                    _preprocess_face_no_landmarks(image, self.image_side)
                 )
 
             # No splits to perform under this scenario, we pack them up as if
@@ -160,20 +287,30 @@ class ArcFace:
         if not preprocessed:
             # TODO: Embedding output depends on the model.
             return [
-                np.empty((0, 512)) for _ in images
+                np.empty((0, 512), dtype=np.float32) for _ in images
             ]
 
         preprocessed = np.stack(preprocessed, axis=0)
 
         # Now turn the (already preprocessed) input into a `torch.Tensor` and
-        # feed through the network.
-        data = torch.tensor(
-            preprocessed, device=self.device, dtype=torch.float32
-        )
+        # feed through the network, in chunks of at most `batch_size` faces so
+        # we don't run out of memory on images with many faces. The faces are
+        # moved to the device as `uint8` without an intermediate copy, and
+        # only there turned into BGR, channels-first float tensors, in a
+        # single pass, to transfer four times less data.
+        features = []
         with torch.no_grad():
-            features = self.model(data).cpu().numpy()
+            for start in range(0, len(preprocessed), self.batch_size):
+                data = torch.from_numpy(
+                    preprocessed[start:start + self.batch_size]
+                ).to(self.device).flip(3).permute(0, 3, 1, 2).to(
+                    torch.float32, memory_format=torch.contiguous_format
+                )
+                features.append(
+                    F.normalize(self.model(data), dim=1).cpu().numpy()
+                )
 
-        features = normalize(features, axis=1)
+        features = np.concatenate(features, axis=0)
 
         features_per_image = np.split(features, splits, axis=0)
 